@@ -58,18 +58,20 @@
 #
 # References
 #
-#   - https://docs.python.org/3/library/urllib.request.html
+#   - https://docs.python.org/3/library/http.client.html
 
 import os
 import sys
-import json
 import time
 import threading
+import http.client
 import http.server
-import urllib.request
+import urllib.parse
 
 import pprint
 
+import orjson
+
 cfg_port = 9100         # the port our webserver listens on
 cfg_stale_thres = 90    # treat metrics as stale if older than this (secs)
 cfg_check_interval = 70 # how often we'll try check for new metrics
@@ -107,78 +109,210 @@ cfg_powerwall_data_file = "/data/powerwall.data"
 # All Powerwall metrics to have this prefix added to them.
 cfg_powerwall_prefix = "teg"
 
-G_metrics_cur = None    # metrics we expose on our web server
-G_metrics_new = None    # metrics we accumulate while iterating through JSON
+G_metrics_bytes = None  # prebuilt "/metrics" payload for vehicle metrics
+G_walk_buf = bytearray() # reusable scratch buffer for the metric walk
 G_last_load = 0         # epoch time that we last loaded fresh JSON data
-G_last_loop = 0         # epoch time of last main loop (to detect thread death)
+G_last_loop = 0         # monotonic time of last main loop (detects thread death)
 G_last_online = 0       # timestamp of when the car was last online
+G_pending_vehicle = None # parsed vehicle_data waiting for the main loop
+G_pending_location = None # parsed location data waiting for the main loop
 
 # -----------------------------------------------------------------------------
 
+# Parsed JSON objects from f_load_json(), keyed by filename. Each entry is
+# a tuple of (mtime, obj) so we only re-parse a file after it has changed.
+
+G_json_cache = {}
+
 # This function is supplied "filename", which should be a JSON file. Our
-# job is to open the file and return a JSON object.
+# job is to open the file and return a JSON object. Since building the
+# dict tree is the expensive part, we keep the previous parse around and
+# hand it back as-is if the file's mtime hasn't moved.
 
 def f_load_json(filename):
   fd = None
   obj = None
   try:
-    fd = open(filename)
-    obj = json.load(fd)
-  except:
-    e = sys.exc_info()
-    print("WARNING: Cannot load '%s' - %s" % (filename, e[1]))
+    mtime = os.stat(filename).st_mtime
+    cached = G_json_cache.get(filename)
+    if (cached is not None) and (cached[0] == mtime):
+      return(cached[1])
+    fd = open(filename, "rb")
+    obj = orjson.loads(fd.read())
+    G_json_cache[filename] = (mtime, obj)
+  except (OSError, orjson.JSONDecodeError) as e:
+    print("WARNING: Cannot load '%s' - %s" % (filename, e))
 
   if (fd is not None):
     fd.close()
   return(obj)
 
-# This function is given a JSON object. Our job is to identify all fields
-# which are metrics, format their values and add it to "G_metrics_new",
-# prepending the metric with "prefix". While iterating through "obj", if
-# we find a nested dict/list, then we call ourself again, with a modified
-# "prefix".
-
-def f_iterate(obj, prefix):
-  fields = obj.keys()
-  for f in fields:
-    if (prefix == ""):
-      field_name = f
-    else:
-      field_name = "%s_%s" % (prefix, f)
+# Formatting helpers for the JSON leaf types we expose. Each one returns
+# a (value, label) tuple, where "value" is the metric's value formatted
+# into a string, and "label" is an optional {label="foo"} body. A value
+# of None means the leaf should be skipped.
+
+# Most numeric fields change slowly (or not at all) between polls, so
+# the same values get formatted over and over. Memoize the formatted
+# strings, capped so unusual payloads can't grow the caches without
+# bound.
+
+G_float_cache = {}
+G_int_cache = {}
+cfg_value_cache_max = 4096
+
+def f_fmt_float(v):
+  s = G_float_cache.get(v)
+  if (s is None):
+    s = f"{v:f}"
+    if (len(G_float_cache) < cfg_value_cache_max):
+      G_float_cache[v] = s
+  return(s, None)
+
+def f_fmt_int(v):
+  s = G_int_cache.get(v)
+  if (s is None):
+    s = str(v)
+    if (len(G_int_cache) < cfg_value_cache_max):
+      G_int_cache[v] = s
+  return(s, None)
+
+def f_fmt_bool(v):
+  if (v):
+    return("1", None)
+  return("0", None)
+
+# Translate table used to sanitize string values into label-safe form:
+# "<" and ">" are dropped, "," and " " become "_". One table lets
+# str.translate() do all of it in a single pass instead of chaining four
+# .replace() calls, each of which allocates a new string.
+
+G_sanitize_tab = str.maketrans({"<": None, ">": None, ",": "_", " ": "_"})
+
+def f_fmt_str(v):
+
+  # if the string is empty (or just white space), ignore it
+
+  s = v.strip()
+  if (len(s) == 0):
+    return(None, None)
+  s = s.translate(G_sanitize_tab)
+  return("1", "value=\"%s\"" % s)
+
+# Leaf handlers keyed on exact type. Because the lookup is on type(v)
+# itself (and not isinstance), bool values land on f_fmt_bool instead of
+# being claimed by the int handler (bool is a subclass of int).
+
+G_fmt_handlers = {float: f_fmt_float,
+                  int: f_fmt_int,
+                  bool: f_fmt_bool,
+                  str: f_fmt_str}
+
+# The JSON schema is stable between polls, so the same ~200 metric name
+# strings get rebuilt from the same (prefix, field) pairs on every cycle.
+# We memoize them here, along with the {value="..."} labeled variants,
+# keyed on (name, label). Both caches are capped so a pathological
+# payload can't grow them without bound.
+
+G_name_cache = {}
+G_label_cache = {}
+cfg_name_cache_max = 4096
 
-    if (type(obj[f]) is dict):
-      f_iterate(obj[f], field_name)
+# This function is given a JSON object. Our job is to identify all fields
+# which are metrics, format their values and append them to "buf" (a
+# bytearray) as ready-to-serve "<name> <value>\n" exposition lines,
+# prepending each metric with "prefix". Rather than calling ourself for
+# every nested dict (which costs a python frame per dict), we keep an
+# explicit work stack and loop until it is empty. Each leaf is dispatched
+# through a single dict lookup on its exact type. Returns the number of
+# metrics appended.
+
+def f_iterate(obj, prefix, buf):
+  count = 0
+  stack = [(obj, prefix)]
+  while (len(stack) > 0):
+    cur, pfx = stack.pop()
+    if (pfx == ""):
+      pfx_ = ""
     else:
+      pfx_ = pfx + "_"
 
-      # based on the data type, figure out how "value" should be represented.
-
-      value = None # always format this into a string
-      label = None # an optional {label="foo"}
+    for f in cur.keys():
+      v = cur[f]
+      t = type(v)
 
-      if (type(obj[f]) is float):                       # float
-        value = "%f" % obj[f]
-      if (type(obj[f]) is int):                         # int
-        value = "%d" % obj[f]
-      if (type(obj[f]) is bool):                        # bool
-        value = 0
-        if (obj[f]):
-          value = 1
-      if (type(obj[f]) is str):                         # str
+      key = (pfx, f)
+      m = G_name_cache.get(key)
+      if (m is None):
+        m = pfx_ + f
+        if (len(G_name_cache) < cfg_name_cache_max):
+          G_name_cache[key] = m
 
-        # if the string is empty (or just white space, ignore it
+      if (t is dict):
+        stack.append((v, m))
+        continue
 
-        s = obj[f].lstrip(" ").rstrip(" ")
-        if (len(s) > 0):
-          value = "1"
-          s = s.replace("<","").replace(">","")
-          s = s.replace(",", "_").replace(" ", "_")
-          label = "value=\"%s\"" % s
+      h = G_fmt_handlers.get(t)
+      if (h is None):
+        continue
+      value, label = h(v)
 
       if (value is not None):
-        m = field_name
         if (label is not None):
-          m = "%s{%s}" % (field_name, label)
-        G_metrics_new[m] = value
+          lkey = (m, label)
+          lm = G_label_cache.get(lkey)
+          if (lm is None):
+            lm = "%s{%s}" % (m, label)
+            if (len(G_label_cache) < cfg_name_cache_max):
+              G_label_cache[lkey] = lm
+          m = lm
+        buf.extend(f"{m} {value}\n".encode())
+        count = count + 1
+  return(count)
+
+# Subtree caches for f_iterate_cached(). For each top-level field of the
+# payload we remember a digest of its serialized bytes along with the
+# exposition lines it produced last time, so subtrees that didn't change
+# between polls (eg, "vehicle_config", "gui_settings") are copied from
+# the cache instead of being re-walked and re-formatted leaf by leaf.
+# Each cache entry is a tuple of (rendered bytes, metric count).
+
+G_subtree_hash = {}
+G_subtree_metrics = {}
+
+# This function behaves like f_iterate(), but before walking each
+# top-level nested dict it checks whether that subtree changed since the
+# previous call, by hashing its orjson serialization (one C pass over
+# the bytes). On a hit the previously rendered lines are appended to
+# "buf" as-is; on a miss the subtree is walked and the result cached.
+# Top-level scalar fields are always walked. Returns the number of
+# metrics appended, like f_iterate().
+
+def f_iterate_cached(obj, prefix, buf):
+  count = 0
+  for f in obj.keys():
+    v = obj[f]
+    if (type(v) is not dict):
+      count = count + f_iterate({f: v}, prefix, buf)
+      continue
+
+    digest = hash(orjson.dumps(v))
+    if (G_subtree_hash.get(f) != digest):
+
+      # walk the subtree into its own buffer so we can cache the result.
+
+      sub = bytearray()
+      if (prefix == ""):
+        n = f_iterate(v, f, sub)
+      else:
+        n = f_iterate(v, "%s_%s" % (prefix, f), sub)
+      G_subtree_hash[f] = digest
+      G_subtree_metrics[f] = (bytes(sub), n)
+
+    cached, n = G_subtree_metrics[f]
+    buf.extend(cached)
+    count = count + n
+  return(count)
 
 # This function returns the (epoch) mtime of the specified file, if something
 # goes wrong, it returns -1.
@@ -186,9 +320,8 @@ def f_iterate(obj, prefix):
 def f_get_file_age(filename):
   try:
     sbuf = os.stat(filename)
-  except:
-    e = sys.exc_info()
-    print("WARNING: Cannot stat() %s - %s" % (filename, e[1]))
+  except OSError as e:
+    print("WARNING: Cannot stat() %s - %s" % (filename, e))
     return(-1)
   return(sbuf.st_mtime)
 
@@ -198,14 +331,35 @@ def f_get_file_age(filename):
 def f_get_token(filename):
   try:
     fd = open(filename)
-  except:
-    e = sys.exc_info()
-    print("WARNING: Cannot open %s - %s" % (filename, e[1]))
+  except OSError as e:
+    print("WARNING: Cannot open %s - %s" % (filename, e))
     return(None)
   token = fd.read().rstrip("\n")
   fd.close()
   return(token)
 
+# The access token gets read on every API call, from inside retry loops
+# that can fire several times per poll cycle. Cache it in memory and only
+# re-read the file when its mtime moves (ie, after a refresh).
+
+G_access_token = None
+G_access_token_mtime = 0
+
+# This function returns our access token. The common case is answered
+# from the in-memory copy at the cost of a single stat(); the token file
+# is only re-read when it has been rewritten.
+
+def f_cached_access_token():
+  global G_access_token, G_access_token_mtime
+
+  mtime = f_get_file_age(cfg_access_token_file)
+  if (G_access_token is not None) and (mtime == G_access_token_mtime):
+    return(G_access_token)
+
+  G_access_token = f_get_token(cfg_access_token_file)
+  G_access_token_mtime = mtime
+  return(G_access_token)
+
 # This function is given a filename, its job is to write "token" into the
 # file.
 
@@ -213,15 +367,55 @@ def f_save_data(filename, data):
   print("NOTICE: updating file '%s'" % filename)
   try:
     fd = open("%s.new" % filename, "w")
-  except:
-    e = sys.exc_info()
-    print("FATAL: Cannot open %s.new for writing - %s" % (filename, e[1]))
+  except OSError as e:
+    print("FATAL: Cannot open %s.new for writing - %s" % (filename, e))
     os._exit(1)
 
   fd.write("%s\n" % data)
   fd.close()
   os.rename("%s.new" % filename, filename)
 
+# Persistent HTTPS connections to the tesla API hosts, keyed by netloc.
+# The TLS handshake dominates the wall time of each API call, so we keep
+# connections alive and reuse them across calls (and across poll cycles).
+
+G_https_conns = {}
+
+# This function performs an HTTPS request against "url", reusing a kept
+# alive connection to the host where possible. On success, the response
+# body is returned as bytes. The server may close an idle connection
+# between polls, in which case the first attempt fails and we retry once
+# on a fresh connection. Any HTTP status other than 2xx (eg, 401 when
+# our access token has expired) is treated as a failure, returning None.
+
+def f_https_request(url, data=None, headers=None, method="GET"):
+  u = urllib.parse.urlsplit(url)
+  path = u.path
+  if (u.query != ""):
+    path = "%s?%s" % (u.path, u.query)
+
+  attempts = 2
+  while (attempts > 0):
+    attempts = attempts - 1
+    conn = G_https_conns.get(u.netloc)
+    if (conn is None):
+      conn = http.client.HTTPSConnection(u.netloc, timeout=30)
+      G_https_conns[u.netloc] = conn
+    try:
+      conn.request(method, path, body=data, headers=headers or {})
+      resp = conn.getresponse()
+      payload = resp.read()
+    except (OSError, http.client.HTTPException) as e:
+      print("NOTICE: %s failed - %s" % (url, e))
+      conn.close()
+      del G_https_conns[u.netloc]
+      continue
+    if (resp.status < 200) or (resp.status > 299):
+      print("NOTICE: %s returned HTTP %d" % (url, resp.status))
+      return(None)
+    return(payload)
+  return(None)
+
 # This function is called if our API call failed while using our access token.
 # Presumably it needs to be updated. This function attempts to do that using
 # the refresh token and writes the new access token into a file. Recall that
@@ -234,39 +428,33 @@ def f_save_data(filename, data):
 #  }
 
 def f_update_access_token():
+  global G_access_token
 
   x = {}
   x["grant_type"] = "refresh_token"
   x["client_id"] = "ownerapi"
   x["refresh_token"] = f_get_token(cfg_refresh_token_file)
   x["scope"] = "openid email offline_access"
-  data = json.dumps(x).encode("ascii")
+  data = orjson.dumps(x)
   hdrs = {}
   hdrs["Content-Type"] = "application/json"
   url = "%s/oauth2/v3/token" % cfg_tesla_auth_url
 
   print("NOTICE: Refreshing access token - %s" % url)
-  req = urllib.request.Request(url, data=data, headers=hdrs, method="POST")
-  try:
-    resp = urllib.request.urlopen(req)
-  except:
-    e = sys.exc_info()
-    print("NOTICE: %s failed - %s" % (url, e[1]))
-    resp = None
-
-  if (resp is not None):                # new access token should be here
-    payload = resp.read()
+  payload = f_https_request(url, data=data, headers=hdrs, method="POST")
+
+  if (payload is not None):             # new access token should be here
     obj = None
     try:
-      obj = json.loads(payload)
-    except:
-      e = sys.exc_info()
-      print("WARNING: No JSON response from %s - %s" % (url, e[1]))
+      obj = orjson.loads(payload)
+    except orjson.JSONDecodeError as e:
+      print("WARNING: No JSON response from %s - %s" % (url, e))
     if ((obj is not None) and
         ("access_token" in obj) and
         ("refresh_token" in obj)):
       f_save_data(cfg_access_token_file, obj["access_token"])
       f_save_data(cfg_refresh_token_file, obj["refresh_token"])
+      G_access_token = None             # force f_cached_access_token to re-read
 
 # This function calls the tesla API's "/products" endpoint, which is expected
 # to return JSON like,
@@ -293,7 +481,7 @@ def f_get_vehicle_id():
   retries = cfg_api_retries
   while (retries > 0):
 
-    access_token = f_get_token(cfg_access_token_file)
+    access_token = f_cached_access_token()
     if (access_token is None):
       return(None)
 
@@ -304,24 +492,16 @@ def f_get_vehicle_id():
     url = "%s/api/1/products" % cfg_tesla_owner_url
 
     print("NOTICE: Listing products - %s" % url)
-    req = urllib.request.Request(url, data=None, headers=hdrs)
-    resp = None
-    try:
-      resp = urllib.request.urlopen(req)
-    except:
-      e = sys.exc_info()
-      print("NOTICE: %s failed - %s" % (url, e[1]))
+    payload = f_https_request(url, headers=hdrs)
 
-    if (resp is None):                  # try to refresh our access token
+    if (payload is None):               # try to refresh our access token
       f_update_access_token()
     else:                               # hopefully we got a JSON response
-      payload = resp.read()
       obj = None
       try:
-        obj = json.loads(payload)
-      except:
-        e = sys.exc_info()
-        print("WARNING: No JSON response from %s - %s" % (url, e[1]))
+        obj = orjson.loads(payload)
+      except orjson.JSONDecodeError as e:
+        print("WARNING: No JSON response from %s - %s" % (url, e))
       if ((obj is not None) and
           ("count" in obj) and
           (obj["count"] > 0) and
@@ -360,28 +540,20 @@ def f_wake_vehicle(id):
     retries = retries - 1
     hdrs = {}
     hdrs["Content-Type"] = "application/json"
-    hdrs["Authorization"] = "Bearer %s" % f_get_token(cfg_access_token_file)
+    hdrs["Authorization"] = "Bearer %s" % f_cached_access_token()
     url = "%s/api/1/vehicles/%d/wake_up" % (cfg_tesla_owner_url, id)
 
     print("NOTICE: waking vehicle %d" % id)
-    req = urllib.request.Request(url, data=None, headers=hdrs, method="POST")
-    resp = None
-    try:
-      resp = urllib.request.urlopen(req)
-    except:
-      e = sys.exc_info()
-      print("NOTICE: %s failed - %s" % (url, e[1]))
+    payload = f_https_request(url, headers=hdrs, method="POST")
 
-    if (resp is None):                  # try to refresh our access token
+    if (payload is None):               # try to refresh our access token
       f_update_access_token()
     else:
-      payload = resp.read()
       obj = None
       try:
-        obj = json.loads(payload)
-      except:
-        e = sys.exc_info()
-        print("WARNING: No JSON response from %s - %s" % (url, e[1]))
+        obj = orjson.loads(payload)
+      except orjson.JSONDecodeError as e:
+        print("WARNING: No JSON response from %s - %s" % (url, e))
       if ((obj is not None) and
           ("response" in obj) and
           (obj["response"] is not None) and
@@ -415,36 +587,40 @@ def f_wake_vehicle(id):
 #  }
 
 def f_get_vehicle_data(id):
+  global G_pending_vehicle
+
   retries = cfg_api_retries
   while (retries > 0):
 
     retries = retries - 1
     hdrs = {}
     hdrs["Content-Type"] = "application/json"
-    hdrs["Authorization"] = "Bearer %s" % f_get_token(cfg_access_token_file)
+    hdrs["Authorization"] = "Bearer %s" % f_cached_access_token()
     url = "%s/api/1/vehicles/%d/vehicle_data" % (cfg_tesla_owner_url, id)
 
     print("NOTICE: Getting vehicle data - %s" % url)
-    req = urllib.request.Request(url, data=None, headers=hdrs)
-    resp = None
-    try:
-      resp = urllib.request.urlopen(req)
-    except:
-      e = sys.exc_info()
-      print("WARNING: %s failed - %s" % (url, e[1]))
+    payload = f_https_request(url, headers=hdrs)
 
-    if (resp is None):                  # try to refresh our access token
+    if (payload is None):               # try to refresh our access token
       f_update_access_token()
     else:                               # hopefully we got a JSON response
-      payload = resp.read()
       obj = None
       try:
-        obj = json.loads(payload)
-      except:
-        e = sys.exc_info()
-        print("WARNING: No JSON response from %s - %s" % (url, e[1]))
+        obj = orjson.loads(payload)
+      except orjson.JSONDecodeError as e:
+        print("WARNING: No JSON response from %s - %s" % (url, e))
       if ((obj is not None) and ("response" in obj)):
-        f_save_data(cfg_vehicle_data_file, str(payload, "UTF-8"))
+
+        # hand the parsed object straight to the main loop; the write to
+        # disk is only for durability across restarts, so it happens in
+        # the background instead of making the main loop re-read and
+        # re-parse the very bytes we already have in memory.
+
+        G_pending_vehicle = obj
+        t = threading.Thread(target=f_save_data,
+                             args=(cfg_vehicle_data_file,
+                                   str(payload, "UTF-8")))
+        t.start()
       return
     time.sleep(cfg_retry_sleep)
 
@@ -454,34 +630,36 @@ def f_get_vehicle_data(id):
 # token or attempt a retry.
 
 def f_get_vehicle_location(id):
+  global G_pending_location
+
   hdrs = {}
   hdrs["Content-Type"] = "application/json"
-  hdrs["Authorization"] = "Bearer %s" % f_get_token(cfg_access_token_file)
+  hdrs["Authorization"] = "Bearer %s" % f_cached_access_token()
   url = "%s/api/1/vehicles/%d/vehicle_data?endpoints=location_data" % \
         (cfg_tesla_owner_url, id)
 
   print("NOTICE: Getting vehicle location - %s" % url)
-  req = urllib.request.Request(url, data=None, headers=hdrs)
-  resp = None
-  try:
-    resp = urllib.request.urlopen(req)
-  except:
-    e = sys.exc_info()
-    print("WARNING: %s failed - %s" % (url, e[1]))
-  if (resp is None):
+  payload = f_https_request(url, headers=hdrs)
+  if (payload is None):
     print("WARNING: %s empty response" % url)
     return
 
-  payload = resp.read()
   obj = None
   try:
-    obj = json.loads(payload)
-  except:
-    e = sys.exc_info()
-    print("WARNING: No JSON response from %s - %s" % (url, e[1]))
+    obj = orjson.loads(payload)
+  except orjson.JSONDecodeError as e:
+    print("WARNING: No JSON response from %s - %s" % (url, e))
 
   if ((obj is not None) and ("response" in obj)):
-    f_save_data(cfg_vehicle_location_file, str(payload, "UTF-8"))
+
+    # as with vehicle data, hand the parsed object straight to the main
+    # loop and keep the file write as a background durability side-effect.
+
+    G_pending_location = obj
+    t = threading.Thread(target=f_save_data,
+                         args=(cfg_vehicle_location_file,
+                               str(payload, "UTF-8")))
+    t.start()
 
 # This function should be called AFTER f_get_vehicle_data() as it won't try
 # updating our token or attempt a retry. It saves Powerwall data to a file.
@@ -489,28 +667,20 @@ def f_get_vehicle_location(id):
 def f_get_powerwall_data(id):
   hdrs = {}
   hdrs["Content-Type"] = "application/json"
-  hdrs["Authorization"] = "Bearer %s" % f_get_token(cfg_access_token_file)
+  hdrs["Authorization"] = "Bearer %s" % f_cached_access_token()
   url = "%s/api/1/energy_sites/%s/live_status" % (cfg_tesla_owner_url, id)
 
   print("NOTICE: Getting Powerwall data - %s" % url)
-  req = urllib.request.Request(url, data=None, headers=hdrs)
-  resp = None
-  try:
-    resp = urllib.request.urlopen(req)
-  except:
-    e = sys.exc_info()
-    print("WARNING: %s failed - %s" % (url, e[1]))
-  if (resp is None):
+  payload = f_https_request(url, headers=hdrs)
+  if (payload is None):
     print("WARNING: %s empty response" % url)
     return
 
-  payload = resp.read()
   obj = None
   try:
-    obj = json.loads(payload)
-  except:
-    e = sys.exc_info()
-    print("WARNING: No JSON response from %s - %s" % (url, e[1]))
+    obj = orjson.loads(payload)
+  except orjson.JSONDecodeError as e:
+    print("WARNING: No JSON response from %s - %s" % (url, e))
 
   if ((obj is not None) and ("response" in obj)):
     f_save_data(cfg_powerwall_data_file, str(payload, "UTF-8"))
@@ -519,6 +689,12 @@ def f_get_powerwall_data(id):
 
 class c_webserver(http.server.BaseHTTPRequestHandler):
 
+  # Speak HTTP/1.1 so prometheus can keep its scrape connection alive
+  # instead of paying TCP setup/teardown on every scrape. This obliges
+  # us to send an accurate Content-Length on every response.
+
+  protocol_version = "HTTP/1.1"
+
   # Suppress log messages by overriding this function with empty code.
 
   def log_message(self, format, *args):
@@ -532,49 +708,59 @@ class c_webserver(http.server.BaseHTTPRequestHandler):
     # if we're called with "/healthz", check if main thread is alive.
 
     if (self.path == "/healthz"):
-      last_loop = time.time() - G_last_loop
+      last_loop = time.monotonic() - G_last_loop
       if (last_loop > cfg_check_interval * 2):  # something's wrong
-        self.send_response(500)
-        self.end_headers()
+        code = 500
         msg = "ERR last_loop:%d secs ago\n" % last_loop
       else:
-        self.send_response(200)
-        self.end_headers()
+        code = 200
         msg = "OK last_loop:%d secs ago\n" % last_loop
-      self.wfile.write(str.encode(msg))
+      body = str.encode(msg)
+      self.send_response(code)
+      self.send_header("Content-Length", "%d" % len(body))
+      self.end_headers()
+      self.wfile.write(body)
       return
 
     # if we're not called with "/metrics", just return a 404.
 
     if (self.path != "/metrics"):
       self.send_response(404)
+      self.send_header("Content-Length", "0")
       self.end_headers()
       return
 
+    # write out the prebuilt vehicle and Powerwall metric buffers. We
+    # snapshot each global into a local first; the main loop publishes
+    # new buffers by rebinding these names (atomic under the GIL), so a
+    # scrape either sees the old buffer or the new one, never a mix,
+    # and never trips over the buffer being cleared mid-request.
+
+    vbuf = G_metrics_bytes
+    pbuf = G_powerwall_bytes
+
+    chunks = []
+    total = 0
+    if (vbuf is not None):
+      chunks.append(vbuf)
+      total = total + len(vbuf)
+    if (pbuf is not None):
+      chunks.append(pbuf)
+      total = total + len(pbuf)
+
     self.send_response(200)
     self.send_header("Content-type", "text/plain")
+    self.send_header("Content-Length", "%d" % total)
     self.end_headers()
-
-    # print out all metrics in G_metrics_cur and G_powerwall_metrics
-
-    buf = ""
-    if (G_metrics_cur is not None):
-      for m in G_metrics_cur.keys():
-        buf += "%s %s\n" % (m, G_metrics_cur[m])
-    if (G_powerwall_id is not None):
-      for m in G_powerwall_metrics.keys():
-        buf += "%s %s\n" % (m, G_powerwall_metrics[m])
-      
-    self.wfile.write(str.encode(buf))
+    self.wfile.writelines(chunks)
     sys.stdout.flush()
 
 def f_webserver():
   try:
-    ws = http.server.HTTPServer(("0.0.0.0", cfg_port), c_webserver)
+    ws = http.server.ThreadingHTTPServer(("0.0.0.0", cfg_port), c_webserver)
     ws.serve_forever()
-  except:
-    e = sys.exc_info()
-    print("FATAL! Cannot setup webservice - %s" % e[1])
+  except OSError as e:
+    print("FATAL! Cannot setup webservice - %s" % e)
     os._exit(1)
 
 # -----------------------------------------------------------------------------
@@ -582,14 +768,15 @@ def f_webserver():
 # if "cfg_powerwall_id_file" exists, load it now.
 
 G_powerwall_id = None
-G_powerwall_last_poll = 0
+G_powerwall_last_poll = -cfg_check_interval
 G_powerwall_metrics = {}
+G_powerwall_bytes = None  # prebuilt "/metrics" payload for Powerwall metrics
 
 fd = None
 try:
   fd = open(cfg_powerwall_id_file, "r")
-except:
-  e = sys.exc_info()
+except OSError:
+  pass
 if (fd is not None):
   G_powerwall_id = fd.read().rstrip("\n")
   print("NOTICE: Using energy_site_id %s." % G_powerwall_id)
@@ -600,14 +787,18 @@ if (fd is not None):
 web_t = threading.Thread(target=f_webserver)
 web_t.start()
 
-# note down mtime of the "cfg_vehicle_data_file", we'll load it the next time
-# it gets updated.
+# note down mtime of the "cfg_vehicle_data_file" so the staleness check
+# has a sensible reference point after a restart. Fresh data arrives via
+# "G_pending_vehicle", handed to us by f_get_vehicle_data().
 
 G_last_load = f_get_file_age (cfg_vehicle_data_file)
 
-# a counter which records the start time of each main loop
+# a counter which records the start time of each main loop. All of the
+# scheduling arithmetic below uses time.monotonic(), which can't jump
+# under NTP corrections or suspend/resume the way the wall clock can;
+# the wall clock is only used for data age and logging.
 
-cycle_start = time.time()
+cycle_start = time.monotonic()
 
 # The current polling frequency
 
@@ -617,7 +808,7 @@ poll_freq = cfg_check_interval
 
 while 1:
 
-  now = time.time()
+  now = time.monotonic()
   G_last_loop = now
 
   # See if is time to poll fresh Powerwall metrics
@@ -627,21 +818,23 @@ while 1:
     G_powerwall_last_poll = now
     f_get_powerwall_data(G_powerwall_id)
 
-    # temporarily use f_iterate() to populate "G_metrics_new" and then
-    # merge its values into "G_powerwall_metrics". Note that we don't add
-    # metrics with the name "timestamp" since this is always changing and
-    # will make our database cardinality go crazy.
+    # walk the payload with f_iterate() and merge the resulting lines
+    # into "G_powerwall_metrics", keyed by metric name so values from
+    # earlier polls get replaced. Note that we don't add metrics with
+    # the name "timestamp" since this is always changing and will make
+    # our database cardinality go crazy.
 
     pwall = f_load_json(cfg_powerwall_data_file)
     if ((pwall is not None) and
         ("response" in pwall) and
         (pwall["response"] is not None)):
-      G_metrics_new = {}
-      f_iterate(pwall["response"], cfg_powerwall_prefix)
-      for k in G_metrics_new.keys():
-        if (k.find("timestamp") < 0):
-          G_powerwall_metrics[k] = G_metrics_new[k]
-      print("NOTICE: %d powerwall metrics loaded." % len(G_metrics_new.keys()))
+      pbuf = bytearray()
+      count = f_iterate(pwall["response"], cfg_powerwall_prefix, pbuf)
+      for line in bytes(pbuf).splitlines(keepends=True):
+        if (line.find(b"timestamp") < 0):
+          G_powerwall_metrics[line.rsplit(b" ", 1)[0]] = line
+      G_powerwall_bytes = b"".join(G_powerwall_metrics.values())
+      print("NOTICE: %d powerwall metrics loaded." % count)
 
   # Get vehicle ID, because this call tells you if the car is online
 
@@ -664,14 +857,15 @@ while 1:
       if (offline_duration > cfg_sleep_allowed):
         f_wake_vehicle(vehicle["id"])
 
-  # Check if vehicle JSON file is new
+  # Check if f_get_vehicle_data() handed us a fresh payload
 
-  age = f_get_file_age (cfg_vehicle_data_file)
-  if (age > G_last_load):
+  if (G_pending_vehicle is not None):
+    age = time.time()
+    obj = G_pending_vehicle
+    G_pending_vehicle = None
 
-    # parse and confirm that "obj" and its data are good before we continue.
+    # confirm that "obj" and its data are good before we continue.
 
-    obj = f_load_json(cfg_vehicle_data_file)
     if ((obj is not None) and
         ("response" in obj) and
         (obj["response"] is not None) and
@@ -679,24 +873,50 @@ while 1:
         (obj["response"]["state"] is not None) and
         (obj["response"]["state"] == "online")):
 
-      G_metrics_new = {}
-      f_iterate(obj["response"], cfg_metrics_prefix)
+      # while we chew through the payload (the longest stretch of pure
+      # python work in the cycle), shrink the GIL switch interval so the
+      # webserver thread can preempt us quickly and scrapes aren't made
+      # to wait behind the whole walk.
 
-      # now try to merge in vehicle location data
-
-      loc = f_load_json(cfg_vehicle_location_file)
-      if ((loc is not None) and
-          ("response" in loc) and
-          (loc["response"] is not None) and
-          ("drive_state" in loc["response"]) and
-          (loc["response"]["drive_state"] is not None)):
-        f_iterate(loc["response"]["drive_state"], 
-                  "%s_drive_state" % cfg_metrics_prefix)
+      old_si = sys.getswitchinterval()
+      sys.setswitchinterval(0.001)
+      try:
 
-      if (len(G_metrics_new.keys()) > 1):
+        # first, merge vehicle location data into the payload's own
+        # "drive_state" before we walk it. Both payloads carry some of
+        # the same fields (shift_state, power, speed, timestamp), and
+        # rendering the two dicts separately would emit those series
+        # twice with conflicting values - which prometheus rejects as
+        # duplicate samples. Updating the dict keeps last-value-wins,
+        # with the location data (fetched later) taking precedence. If
+        # this cycle's fetch didn't hand us any location data, fall
+        # back to the last copy on disk.
+
+        loc = G_pending_location
+        G_pending_location = None
+        if (loc is None):
+          loc = f_load_json(cfg_vehicle_location_file)
+        if ((loc is not None) and
+            ("response" in loc) and
+            (loc["response"] is not None) and
+            ("drive_state" in loc["response"]) and
+            (loc["response"]["drive_state"] is not None)):
+          vds = obj["response"].get("drive_state")
+          if (vds is not None):
+            vds.update(loc["response"]["drive_state"])
+          else:
+            obj["response"]["drive_state"] = loc["response"]["drive_state"]
+
+        G_walk_buf.clear()
+        count = f_iterate_cached(obj["response"], cfg_metrics_prefix,
+                                 G_walk_buf)
+      finally:
+        sys.setswitchinterval(old_si)
+
+      if (count > 1):
         print("NOTICE: %d vehicle metrics loaded with age %.3fsecs." % \
-              (len(G_metrics_new.keys()), time.time() - age))
-        G_metrics_cur = G_metrics_new
+              (count, time.time() - age))
+        G_metrics_bytes = bytes(G_walk_buf)
         G_last_load = age
 
         # if vehicle's "shift_state" is "D", we'll want to poll vehicle
@@ -709,22 +929,28 @@ while 1:
            (obj["response"]["drive_state"]["shift_state"] == "D"):
           poll_freq = cfg_drive_interval
 
-  # if vehicle JSON file is stale, then "G_metrics_cur" is stale too
+  # if vehicle data hasn't been refreshed in a while, then the published
+  # "G_metrics_bytes" snapshot is stale too
 
-  if (G_metrics_cur is not None) and (time.time() - age > cfg_stale_thres):
-    print("NOTICE: metrics are now stale, age %.3fsec" % age)
-    G_metrics_cur = None
+  stale_for = time.time() - G_last_load
+  if (G_metrics_bytes is not None) and (stale_for > cfg_stale_thres):
+    print("NOTICE: metrics are now stale, age %.3fsec" % stale_for)
+    G_metrics_bytes = None
 
-  # calculate how long we'll sleep
+  # calculate how long we'll sleep. The sleep is clamped to "poll_freq"
+  # (in case the polling frequency just shrank), and if we've fallen
+  # behind schedule we restart the schedule from now rather than running
+  # back-to-back catch-up cycles.
 
-  tv_end = time.time()
+  tv_end = time.monotonic()
   cycle_start = cycle_start + poll_freq
-  duration = cycle_start - tv_end
+  duration = min(cycle_start - tv_end, poll_freq)
   if (duration > 0):
     print("NOTICE: cycle ended at %.3f, sleeping for %.3f secs." %
           (tv_end, duration))
     sys.stdout.flush()
     time.sleep(duration)
   else:
+    cycle_start = tv_end
     sys.stdout.flush()
 